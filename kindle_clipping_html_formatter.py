@@ -4,22 +4,47 @@ import re
 import os
 from datetime import datetime
 import argparse
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, TYPE_CHECKING
 
 from kindle_clipping_html_templates import PAGE, HIGHLIGHT
 
+if TYPE_CHECKING:
+    # only needed for annotations, supabase is imported on first use so HTML-only runs don't pay for it
+    from supabase import Client
+
 HIGHLIGHT_SEPARATOR = "=========="
 OUTPUT_DATE_FORMAT = "%d/%m/%y %H:%M:%S"
+SUPABASE_BATCH_SIZE = 500  # max rows per upsert request
+SUPABASE_MAX_WORKERS = 8  # books uploaded concurrently
+
+# chars that are not alphanumeric or ; , _ - . ( ) ' "
+_TITLE_STRIP = re.compile(r"[^a-zA-Z\d\s;,_\-\.()'\"]+")
+# anything that isn't a word at the start & end
+_EDGE_STRIP = re.compile(r"^\W+|\W+$")
+# a whole clipping, expected shape:
+#   Book Title (Author)
+#   - Your Highlight on page 57 | Location 866-867 | Added on Wednesday, October 24, 2018 10:25:36 PM
+#   <blank line>
+#   content, possibly over several lines
+_CLIPPING = re.compile(
+    r"\n?(?P<title>[^\n]*?)\((?P<author>[^)\n]*)\)[^(\n]*\n"  # author is the last content in round brackets
+    r"- Your (?P<type>[^\n]*?) on (?:[^\n|]*? \| )?(?P<loc>[^\n|]*?) \| Added on (?P<date>[^\n]*)\n"
+    r"[^\n]*\n"
+    r"(?P<content>.*)\n[^\n]*\Z",
+    re.DOTALL
+)
+# chars that are not allowed in file names
+_FILENAME_BAD = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+_SUPABASE: Optional["Client"] = None  # shared client, created on first use
 
 
 ########################################################################################################################
 class Book:
-    book_titles = set()  # maintain a set of book titles
-
     ####################################################################################################################
     def __init__(self, title, author):
-        self.title = Book.tidy_title(title)
-        Book.book_titles.add(self.title)  # add book to list of known books
+        self.title = title  # expected to already be tidied by Highlight.parse_highlight
         self.author = author
         self.highlights = []
 
@@ -32,44 +57,48 @@ class Book:
     def highlights_to_html(self):
         # iterate over all highlights creating HTML for each
         for highlight in self.highlights:
-            yield HIGHLIGHT.safe_substitute({
-                'text': highlight.content,
-                'location': highlight.main_loc,
-                'datetime': highlight.date
-            })
+            yield HIGHLIGHT.format(
+                text=highlight.content,
+                location=highlight.main_loc,
+                datetime=highlight.date.strftime(OUTPUT_DATE_FORMAT)
+            )
 
     ####################################################################################################################
-    def write_book_to_supabase(self):
-        supabase: Client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
-
-        len_highlights = len(self.highlights)
-        counter = 1
+    def write_book_to_supabase(self, supabase: "Client"):
+        rows = []
+        seen = set()
         for highlight in self.highlights:
-            print("Checking highlight" + str(counter) + " of " + str(len_highlights))
             highlight_hash = highlight.to_hash()
+            if highlight_hash in seen:
+                continue
+            seen.add(highlight_hash)  # skip duplicate highlights within the same book
+            rows.append({
+                "hash": highlight_hash,
+                "title": self.title,
+                "author": self.author,
+                "highlight_type": highlight.highlight_type,
+                "main_loc": highlight.main_loc,
+                "content": highlight.content,
+                "timestamp": convert_date_to_iso(highlight.date)
+            })
+
+        len_highlights = len(self.highlights)
+        print(f"Uploading {len_highlights} highlights for {self.title}")
+        # the unique index on hash lets the database skip highlights that are already stored
+        inserted = 0
+        for start in range(0, len(rows), SUPABASE_BATCH_SIZE):
             data = supabase.table("clippings") \
-                .select("hash") \
-                .filter("hash", "eq", highlight_hash) \
+                .upsert(rows[start:start + SUPABASE_BATCH_SIZE], on_conflict="hash", ignore_duplicates=True) \
                 .execute()
-
-            if len(data.data) == 0:
-                data = supabase.table("clippings").insert({
-                    "hash": highlight_hash,
-                    "title": self.title,
-                    "author": self.author,
-                    "highlight_type": highlight.highlight_type,
-                    "main_loc": highlight.main_loc,
-                    "content": highlight.content,
-                    "timestamp": convert_date_to_iso(highlight.date)
-                }).execute()
-
-            counter += 1
+            inserted += len(data.data)  # only newly inserted rows are returned
+        # books upload concurrently, so name the book again rather than relying on line order
+        print(f"  -> {self.title}: inserted {inserted}, skipped {len_highlights - inserted}")
 
     ####################################################################################################################
-    def write_book_to_html(self):
-        """Writes all book attributes to a HTML file."""
+    def write_book_to_html(self, output_dir):
+        """Writes all book attributes to a HTML file in output_dir."""
         # get filename from book title and output file extension
-        filename = "{}.html".format(self.title)
+        filename = os.path.join(output_dir, "{}.html".format(_FILENAME_BAD.sub("_", self.title)[:200]))
 
         # get all the highlights as HTML
         highlights_html = self.highlights_to_html()
@@ -77,26 +106,24 @@ class Book:
         # get current datetime in our format
         datetime_now = datetime.now().strftime(OUTPUT_DATE_FORMAT)
 
-        # write the book to HTML
-        with open(filename, 'w', encoding="utf-8") as book_file:
+        # write the book to a temporary file, then swap it in so a failed run never leaves a truncated file
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, 'w', encoding="utf-8") as book_file:
             book_file.write(PAGE.safe_substitute({
                 'book_title': self.title,
                 'book_author': self.author,
                 'file_datetime': datetime_now,
-                'book_highlights': '\n'.join(list(highlights_html))
+                'book_highlights': '\n'.join(highlights_html)
             }))
-            # give status prompt to user
-            print(f"HTML file produced for: {self.title}")
+        os.replace(temp_filename, filename)
+        # give status prompt to user
+        print(f"HTML file produced for: {self.title}")
 
     ####################################################################################################################
     @staticmethod
     def tidy_title(raw_title):
         """ Removed unwanted characters from the highlight title. """
-        # remove chars tht are not alphanumeric or ; , _ - . ( ) ' "
-        title = re.sub(r"[^a-zA-Z\d\s;,_\-\.()'\"]+", "", str(raw_title))
-        # Trim off anything that isn't a word at the start & end
-        title = re.sub(r"^\W+|\W+$", "", title)
-        return title
+        return _EDGE_STRIP.sub("", _TITLE_STRIP.sub("", str(raw_title)))
 
 ########################################################################################################################
 
@@ -109,41 +136,23 @@ class Highlight:
         # (title, author, highlight_type, main_loc, date, content)
         self.title, self.author, self.highlight_type, self.main_loc, self.date, self.content = \
             Highlight.parse_highlight(raw_highlight_str)
+        # content never changes, so hash it once up front
+        self._hash = hashlib.sha1(self.content.encode('utf-8')).hexdigest() if self.content is not None else None
 
     def to_hash(self):
-        return hashlib.sha1(self.content.encode('utf-8')).hexdigest()
+        return self._hash
         # return hash((self.title, self.author, self.main_loc))
 
     ####################################################################################################################
     @staticmethod
     def tidy_date(raw_date):
-        """ Tidies a clipping date into our desired format. """
+        """ Parses a clipping date into a datetime. """
         # remove unwanted preface
         date_str = raw_date.replace('Added on ', '')
         # expected date_str: Wednesday, October 24, 2018 10:25:36 PM
         # https://pythonexamples.org/python-datetime-format/
         input_date_format = '%A, %B %d, %Y %H:%M:%S %p'
-        datetime_object = datetime.strptime(date_str, input_date_format)
-        return datetime_object.strftime(OUTPUT_DATE_FORMAT)
-
-    ####################################################################################################################
-    @staticmethod
-    def get_type_and_location(loc_str):
-        """ Expected values:
-            - Your Highlight on Location 6105-6113
-            - Your Note on page 57 | Location 866
-        """
-        loc_str = loc_str.replace("- Your ", "").strip();
-        type_and_location = loc_str.split(" on ")
-        highlight_type = type_and_location[0]
-
-        page_and_location = type_and_location[1].split(" | ")
-        if len(page_and_location) == 1:
-            highlight_location = page_and_location[0]
-        else:
-            highlight_location = page_and_location[1]
-
-        return highlight_type.strip(), highlight_location.strip()
+        return datetime.strptime(date_str, input_date_format)
 
     ####################################################################################################################
     @staticmethod
@@ -155,48 +164,23 @@ class Highlight:
         """
         empty_set = (None, None, None, None, None, None)
 
-        # split the highlight up by line
-        split_str = raw_highlight_str.split('\n')
-        # ensure has enough lines
-        if len(split_str) < 5:
+        # too short to hold the details line alone, e.g. a separator-only chunk
+        if len(raw_highlight_str) < 40:
             return empty_set
 
-        # determine if we are not on the first clipping in the file
-        if split_str[0] == '':
-            # remove the first split as it was a separator originally
-            split_str = split_str[1:]
-
-        # get book title and author
-        book_details = split_str[0]
-        # get last content in round brackets
-        book_details_split = re.search(r"\(([^)]*)\)[^(]*$", book_details)
-        if book_details_split:
-            # get the title and author from the split result
-            title = Book.tidy_title(book_details[:book_details_split.start()])
-            author = book_details_split.group(1)
-        else:
+        clipping = _CLIPPING.match(raw_highlight_str)
+        if not clipping:
             return empty_set
 
-        # get highlight details
-        highlight_details = split_str[1]
-        highlight_details_split = highlight_details.split(" | Added on ")
-        if highlight_details_split:
-            # get the main location and highlight date from the split result
+        title = Book.tidy_title(clipping.group('title'))
+        author = clipping.group('author')
+        highlight_type = clipping.group('type')
+        main_loc = clipping.group('loc')
 
-            type_and_location = Highlight.get_type_and_location(highlight_details_split[0])
-            highlight_type = type_and_location[0]
-            main_loc = type_and_location[1]
+        # parse the date once, it is only formatted when written out
+        date = Highlight.tidy_date(clipping.group('date'))
 
-            date = highlight_details_split[1]
-
-        else:
-            return empty_set
-
-        # tidy our date up into our desired format
-        date = Highlight.tidy_date(date)
-
-        # get the highlight content
-        content = '\n'.join(split_str[3:-1])
+        content = clipping.group('content')
 
         return title.strip(), \
             author.strip(), \
@@ -208,62 +192,72 @@ class Highlight:
 ########################################################################################################################
 
 
-def convert_date_to_iso(datestring):
-    return datetime.strptime(datestring, OUTPUT_DATE_FORMAT).isoformat()
-
+def _get_client():
+    """ Returns the shared Supabase client, creating it on first use. """
+    global _SUPABASE
+    if _SUPABASE is None:
+        from supabase import create_client
+        _SUPABASE = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+    return _SUPABASE
 
-def process(clippings_file_path, output_dir_path):
-    processed_books = []
-    library = []
 
-    # move to the cwd
-    cwd = os.getcwd()
-    os.chdir(cwd)
-    # create output folder if not exists
-    if not os.path.exists(output_dir_path):
-        os.mkdir(output_dir_path)
+def convert_date_to_iso(date):
+    return date.isoformat()
 
-    # reset knowledge of book titles
-    Book.book_titles = set()
 
-    # read in the clippings
+def iter_clippings(clippings_file_path):
+    """ Yields each raw highlight string from the clippings file, reading one line at a time. """
+    buffer = []
     with open(clippings_file_path, "r", encoding='utf-8') as clippings_file:
-        file_contents = clippings_file.read()
+        for line in clippings_file:
+            if line.strip() == HIGHLIGHT_SEPARATOR:
+                yield "".join(buffer)
+                buffer = []
+            else:
+                buffer.append(line)
+    # anything left after the final separator
+    if buffer:
+        yield "".join(buffer)
 
-    # move to the output directory
-    os.chdir(output_dir_path)
 
-    # split all the highlights up into a list
-    highlights = file_contents.split(HIGHLIGHT_SEPARATOR)
+def process(clippings_file_path, output_dir_path):
+    library = []
+    books_by_title = {}  # title -> Book, for constant time lookup per highlight
+
+    # create output folder if not exists
+    os.makedirs(output_dir_path, exist_ok=True)
 
-    # process each highlight
-    for raw_str in highlights:
+    # stream each highlight from the clippings file
+    for raw_str in iter_clippings(clippings_file_path):
+        # blank chunks can't hold a highlight, so don't bother parsing them
+        if not raw_str or not raw_str.strip():
+            continue
         h = Highlight(raw_str)
+        # skip anything that didn't parse or has no usable title
+        if not h.title:
+            continue
         # if haven't seen the book title before create a new book, then add the highlight
-        if (not h.title is None) and (h.title not in Book.book_titles):
-            b = Book(h.title, h.author)
-            b.add_highlight(h)  # add highlight to book
-            library.append(b)  # add the new book to our library
-        else:
-            # check all other books we know about to add highlight to its own book
-            for b in library:
-                if b.title == h.title:
-                    b.add_highlight(h)
-
-    # process each book in our library
-    for book in library:
-        if book.title:
-            # if we haven't processed the book, process now
-            if book.title.strip() not in processed_books:
-                # book.write_book_to_html()
-                book.write_book_to_supabase();
-                processed_books.append(book.title.strip())  # add the book as processed
-            else:
-                print(f"HTML file already produced for: {book.title}")
+        book = books_by_title.get(h.title)
+        if book is None:
+            book = Book(h.title, h.author)
+            books_by_title[h.title] = book
+            library.append(book)  # add the new book to our library
+        book.add_highlight(h)  # add highlight to its book
+
+    # one client drives the uploads for every book
+    client = _get_client()
+
+    # process each book in our library, books are already unique by title
+    # for book in library:
+    #     book.write_book_to_html(output_dir_path)
+
+    # uploads are network bound, so overlap them across books (the client is safe to share between threads)
+    with ThreadPoolExecutor(max_workers=SUPABASE_MAX_WORKERS) as executor:
+        list(executor.map(lambda b: b.write_book_to_supabase(client), library))
 
 
 def generate_supabase_user():
-    supabase: Client = create_client(config.SUPABASE_URL, config.SUPABASE_KEY)
+    supabase: "Client" = _get_client()
     user = supabase.auth.sign_up(email=config.SUPABASE_USER, password=config.SUPABASE_USER_PW)
 
 
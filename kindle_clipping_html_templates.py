@@ -48,10 +48,11 @@ PAGE = Template('''
 </body>
 </html>''')
 
-HIGHLIGHT = Template('''
+# plain format string, filled in once per highlight so it avoids re-parsing a Template each time
+HIGHLIGHT = '''
         <li>
             <blockquote>
-                $text
-                <span>($location, $datetime)</span>
+                {text}
+                <span>({location}, {datetime})</span>
             </blockquote>
-        </li>''')
+        </li>'''